@@ -6,18 +6,39 @@
 # Date 27 Jan 2020
 
 import argparse
+import collections
+import concurrent.futures
 import csv
 import datetime
 import glob
-
+import heapq
 import os
+import re
+import select
+import socket
 import subprocess
 import sys
 import time
+import zipfile
 from pathlib import Path
 
 from astropy.io.votable import parse_single_table
+import numpy as np
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+# Matches the names of job completed or failed status files, e.g. 12.COMPLETED
+STATUS_RE = re.compile(r'^(\d+)\.(COMPLETED|FAILED)$')
 
+# Number of times a job's submission may fail before the daemon stops
+MAX_SUBMIT_ATTEMPTS = 3
+
+# Positions of the per job arguments in the commands from build_job_template
+QSUB_VARS_IDX, QSUB_NAME_IDX, QSUB_OUT_IDX, QSUB_ERR_IDX = 2, 4, 6, 8
+JOB_ID_IDX = 1
 
 class CommandFailedError(Exception):
     def __init__(self, value):
@@ -34,7 +55,7 @@ def parseargs():
     """
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
                                      description="Daemon process to manage the production of cutouts for each component from an ASKAP scheduing block")
-    parser.add_argument("-d", "--delay", help="Number of seconds to pause between scans for completed jobs",
+    parser.add_argument("-d", "--delay", help="Maximum number of seconds to pause between scans for completed jobs",
                         type=int, default=30)
     parser.add_argument("-s", "--sbid", help="The id of the ASKAP scheduling block to be processed",
                         type=int, required=True)
@@ -42,7 +63,8 @@ def parseargs():
                         default='status')
     parser.add_argument("-f", "--filename", help="The name of the csv format file listing the components to be processed and their beams.",
                         default='smc_srcs_image_params.vot')
-    parser.add_argument("-m", "--max_loops", help="The maximum number of processing loops the daemon will run.",
+    parser.add_argument("-m", "--max_loops", help="The number of delay periods the daemon will run for, " +
+                        "limiting the run to max_loops x delay seconds.",
                         type=int, default=500)
     parser.add_argument("-c", "--concurrency_limit", help="The maximum number of concurrent processes allowed to run.",
                         type=int, default=12)
@@ -52,6 +74,9 @@ def parseargs():
 
     parser.add_argument("--pbs", help="Run the jobs via PBS qsub command", default=False,
                         action='store_true')
+    parser.add_argument("--use_job_array", help="Submit all jobs at once as a PBS job array, if no jobs would share " +
+                        "measurement sets beyond the minimum concurrency limit. Requires --pbs", default=False,
+                        action='store_true')
     parser.add_argument("-l", "--log_folder", help="The folder which will contain the stdout and stderr files from the jobs",
                         default='logs')
     parser.add_argument("-a", "--active", help="The numerical component index of an active cutout job. The job will be monitored as if this daemon started it",
@@ -62,7 +87,11 @@ def parseargs():
                         type=str)
     parser.add_argument("--retry_failed", help="Cleanup any already failed jobs and retry them", default=False,
                         action='store_true')
+    parser.add_argument("-v", "--verbose", help="Report each job which had already finished before the daemon started", 
+                        default=False, action='store_true')
     args = parser.parse_args()
+    if args.use_job_array and not args.pbs:
+        parser.error('--use_job_array requires --pbs')
     return args
 
 
@@ -70,24 +99,183 @@ def run_os_cmd(cmd, failOnErr=True):
     """
     Run an operating system command ensuring that it finishes successfully.
     If the comand fails, the program will exit.
-    :param cmd: The command to be run
-    :return: None
+    :param cmd: The command to be run, as a list of the program and its arguments
+    :return: The return code of the command, or None if it could not be run
     """
-    print(">", cmd)
-    sys.stdout.flush()
+    cmd_str = ' '.join(cmd)
+    print(">", cmd_str)
+    retcode = None
     try:
-        retcode = subprocess.call(cmd, shell=True)
+        retcode = subprocess.run(cmd, check=False).returncode
         if retcode != 0:
-            message = "Command '"+cmd+"' failed with code " + str(retcode)
+            message = "Command '"+cmd_str+"' failed with code " + str(retcode)
             print(message, file=sys.stderr)
             if failOnErr:
                 raise CommandFailedError(message)
     except OSError as e:
-        message = "Command '" + cmd + "' failed " + e
+        message = "Command '" + cmd_str + "' failed " + str(e)
         print(message, file=sys.stderr)
         if failOnErr:
             raise CommandFailedError(message)
-    return None
+    return retcode
+
+
+def build_job_template(sbid, status_folder, log_folder, use_pbs):
+    """
+    Build the static parts of the command used to start a job, to be completed by launch_job.
+
+    Parameters
+    ----------
+    sbid: int
+        The id of the ASKAP scheduling block being processed.
+    status_folder: str
+        The folder which will contain the job completion or failed files.
+    log_folder: str
+        The folder which will contain the stdout and stderr files from PBS jobs.
+    use_pbs: bool
+        True if the jobs will be submitted via PBS qsub, False to run them directly.
+
+    Returns
+    -------
+    The command as a list of the program and its arguments.
+    """
+    me = Path(__file__)
+    script = str(Path(me.parent, 'start_job.pbs'))
+    script_folder = str(me.parent)
+
+    if use_pbs:
+        # The component index is added to the start of the variable list and the end of the name and log paths
+        return ['qsub', '-v', ',SBID={0},STATUS_DIR={1},SCRIPT_DIR={2}'.format(sbid, status_folder, script_folder),
+                '-N', 'ASKAP_abs',
+                '-o', '{}/askap_abs_'.format(log_folder),
+                '-e', '{}/askap_abs_'.format(log_folder),
+                script]
+    return [script, '', str(sbid), status_folder]
+
+
+def launch_job(array_id, job_template, use_pbs, status_socket=None, submit_pool=None):
+    """
+    Start the job to produce the cutout for a component without waiting for it to finish.
+
+    Parameters
+    ----------
+    array_id: int
+        The numerical id of the component to be processed.
+    job_template: list
+        The command to start a job, as produced by build_job_template.
+    use_pbs: bool
+        True if the job should be submitted via PBS qsub, False to run it directly.
+    status_socket: str
+        The path of the socket on which a directly run job should wake the daemon when it finishes, if any.
+    submit_pool: Executor
+        The pool to run qsub submissions in, if any.
+
+    Returns
+    -------
+    The Popen instance for the launched process, or a Future for the return code of the qsub submission 
+    if a submit_pool is supplied.
+    """
+    cmd = list(job_template)
+    id_str = str(array_id)
+    env = None
+    if use_pbs:
+        cmd[QSUB_VARS_IDX] = 'COMP_INDEX=' + id_str + cmd[QSUB_VARS_IDX]
+        cmd[QSUB_NAME_IDX] += id_str
+        cmd[QSUB_OUT_IDX] += id_str + '_o.log'
+        cmd[QSUB_ERR_IDX] += id_str + '_e.log'
+        if submit_pool is not None:
+            # qsub only waits on the PBS server, so several submissions can be in progress at once
+            return submit_pool.submit(run_os_cmd, cmd, failOnErr=False)
+    else:
+        cmd[JOB_ID_IDX] = id_str
+        if status_socket:
+            env = dict(os.environ, STATUS_SOCKET=status_socket)
+    print(">", ' '.join(cmd))
+    try:
+        return subprocess.Popen(cmd, env=env)
+    except OSError as e:
+        message = "Command '{}' failed {}".format(' '.join(cmd), e)
+        print(message, file=sys.stderr)
+        raise CommandFailedError(message)
+
+
+def submit_job_array(first_id, last_id, sbid, status_folder, log_folder, concurrency_limit):
+    """
+    Submit a single PBS job array to produce the cutouts for a range of components.
+
+    Parameters
+    ----------
+    first_id: int
+        The numerical id of the first component to be processed.
+    last_id: int
+        The numerical id of the last component to be processed.
+    sbid: int
+        The id of the ASKAP scheduling block being processed.
+    status_folder: str
+        The folder which will contain the job completion or failed files.
+    log_folder: str
+        The folder which will contain the stdout and stderr files from the jobs.
+    concurrency_limit: int
+        The maximum number of jobs from the array which PBS should run at once.
+    """
+    me = Path(__file__)
+    script = str(Path(me.parent, 'start_job.pbs'))
+    script_folder = str(me.parent)
+
+    # PBS replaces ^array_index^ with the index of each subjob
+    cmd = ['qsub', '-J', '{}-{}'.format(first_id, last_id), 
+           '-W', 'max_run_subjobs={}'.format(concurrency_limit),
+           '-v', 'SBID={0},STATUS_DIR={1},SCRIPT_DIR={2}'.format(sbid, status_folder, script_folder),
+           '-N', 'ASKAP_abs{}'.format(sbid),
+           '-o', '{}/askap_abs_^array_index^_o.log'.format(log_folder),
+           '-e', '{}/askap_abs_^array_index^_e.log'.format(log_folder),
+           script]
+    run_os_cmd(cmd)
+
+
+def check_launches(pending_launches):
+    """
+    Check on the processes started by launch_job, reporting any which have failed.
+
+    Parameters
+    ----------
+    pending_launches: list
+        List of (array_id, Popen or Future) tuples for the processes which have not yet been seen to finish. 
+        Finished processes are removed from the list.
+
+    Returns
+    -------
+    List of the numerical ids of the components whose launch process failed.
+
+    Raises
+    ------
+    CommandFailedError
+        If a qsub submission could not be run at all.
+    """
+    failed_launches = []
+    still_running = []
+    for array_id, proc in pending_launches:
+        if isinstance(proc, concurrent.futures.Future):
+            if not proc.done():
+                still_running.append((array_id, proc))
+                continue
+            retcode = proc.result()
+            if retcode is None:
+                # The command could not be run (e.g. qsub is not available), so retrying won't help
+                raise CommandFailedError('Unable to run the submission for job #{}'.format(array_id))
+            if retcode != 0:
+                # run_os_cmd has already reported the failure
+                failed_launches.append(array_id)
+            continue
+
+        retcode = proc.poll()
+        if retcode is None:
+            still_running.append((array_id, proc))
+        elif retcode != 0:
+            print("Command '{}' failed with code {}".format(' '.join(proc.args), retcode), file=sys.stderr)
+            failed_launches.append(array_id)
+    pending_launches[:] = still_running
+    return failed_launches
 
 
 def get_source_list(filename):
@@ -101,7 +289,7 @@ def get_source_list(filename):
     
     Returns
     -------
-    List of the sources in the same order as the csv file and a map of source names to beam lists.
+    List of the sources in the same order as the csv file and a map of source names to beam sets.
     """
     src_beam_map = dict()
     targets = []
@@ -117,181 +305,542 @@ def get_source_list(filename):
             #dec = float(row[3])
             beams = row[4:]
             targets.append(comp_name)
-            src_beam_map[comp_name] = beams
+            src_beam_map[comp_name] = frozenset(beams)
     return targets, src_beam_map
 
 
+def load_image_params_cache(cache):
+    # Returns the cached (targets, names, beams), or None if the cache is missing or unreadable
+    if not os.path.exists(cache):
+        return None
+    try:
+        # Only plain arrays are cached, so pickled objects are never loaded
+        with np.load(cache, allow_pickle=False) as cached:
+            return cached['targets'].tolist(), cached['names'], cached['beams']
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile) as e:
+        print ('Ignoring unreadable image params cache {}: {}'.format(cache, e))
+        return None
+
+
+def save_image_params_cache(filename, cache, targets, names, beams):
+    # Convert to plain arrays, skipping the cache if that isn't possible (e.g. masked values)
+    cache_arrays = dict(targets=np.asarray(targets), names=np.asarray(names.tolist()), beams=np.asarray(beams.tolist()))
+    if any(array.dtype.hasobject for array in cache_arrays.values()):
+        return
+
+    tmp_cache = '{}.{}.tmp'.format(cache, os.getpid())
+    try:
+        # Remove caches from earlier versions of the file, which are named <filename>.<mtime_ns>.<size>.npz
+        for old_cache in glob.glob(glob.escape(filename) + '.*.*.npz'):
+            cache_key = old_cache[len(filename)+1:-len('.npz')].split('.')
+            if old_cache != cache and len(cache_key) == 2 and all(field.isdigit() for field in cache_key):
+                os.remove(old_cache)
+
+        # Write to a temporary file first so an interrupted write never leaves a partial cache
+        with open(tmp_cache, 'wb') as cache_file:
+            np.savez(cache_file, **cache_arrays)
+        os.replace(tmp_cache, cache)
+    except OSError as e:
+        print ('Unable to cache image params to {}: {}'.format(cache, e))
+        if os.path.exists(tmp_cache):
+            os.remove(tmp_cache)
+
+
 def read_image_params(filename):
     # targets - array with an entry per source - has a 'component_name' entry per row
-    # image_params - array with component_name and beam_ids entries per row - one entry per source/beam combo
+    # names, beams - plain arrays of the component_name and beam_ids columns - one entry per source/beam combo
+    # The parsed values are cached alongside the file, keyed by its modification time and size
+    st = os.stat(filename)
+    cache = '{}.{}.{}.npz'.format(filename, st.st_mtime_ns, st.st_size)
+    cached = load_image_params_cache(cache)
+    if cached is not None:
+        return cached
+
     table = parse_single_table(filename, pedantic=False)
     image_params = table.array
-    targets = []
-    for row in image_params:
-        if row['component_name'] not in targets:
-            targets.append(row['component_name'])
-    return targets, image_params
+    # Extract the columns once to avoid masked array access for each row
+    names = np.asarray(image_params['component_name'])
+    beams = np.asarray(image_params['beam_ids'])
+    # Unique names in the order they were first seen
+    _, first_idx = np.unique(names, return_index=True)
+    targets = names[np.sort(first_idx)].tolist()
+    save_image_params_cache(filename, cache, targets, names, beams)
+    return targets, names, beams
 
 
-def build_map(image_params):
+def build_map(names, beams):
     # Build map of sources to beam ids
-    src_beam_map = dict()
-    for row in image_params:
-        comp_name = row['component_name']
-        beam_id = row['beam_ids']
-        if comp_name not in src_beam_map.keys():
-            beams = set()
-            src_beam_map[comp_name] = beams
-        beams = src_beam_map[comp_name]
-        beams.add(beam_id)
-    return src_beam_map
-
-
-def register_active(targets, src_beam_map, active_ids, active_ms, pre_active_jobs, remaining_array_ids, status_folder):
+    if len(names) == 0:
+        return dict()
+    # Group the beams by sorting on name and splitting where the name changes
+    order = np.argsort(names, kind='stable')
+    sorted_names = names[order]
+    sorted_beams = beams[order]
+    cuts = np.flatnonzero(sorted_names[1:] != sorted_names[:-1]) + 1
+    groups = np.split(sorted_beams, cuts)
+    labels = sorted_names[np.r_[0, cuts]]
+    return {comp_name: frozenset(group.tolist()) for comp_name, group in zip(labels.tolist(), groups)}
+
+
+def build_ms_index(targets, src_beam_map):
+    # Build map of ms to the ids of the components which use them
+    ms_to_ids = collections.defaultdict(set)
+    for idx, comp_name in enumerate(targets):
+        for ms in src_beam_map[comp_name]:
+            ms_to_ids[ms].add(idx+1)
+    return ms_to_ids
+
+
+def find_job_array_ids(targets, name_to_id, src_beam_map, status_folder, remaining_array_ids, active_ids, active_ms, 
+                       concurrency_limit, min_concurrency_limit):
+    """
+    Work out which jobs can be submitted together as a PBS job array.
+
+    Parameters
+    ----------
+    targets: str[]
+        List of the component names of possible targets.
+    name_to_id: dict
+        Map of component names to the first id they are listed with.
+    src_beam_map: dict
+        Map of component names to the set of ms they use.
+    status_folder: str
+        The folder which will contain the job completion or failed files.
+    remaining_array_ids: dict
+        The numerical ids of the jobs still to be processed.
+    active_ids: set
+        The numerical ids of the jobs which are already running.
+    active_ms: Counter
+        The number of active jobs using each ms.
+    concurrency_limit: int
+        The maximum number of concurrent processes allowed to run.
+    min_concurrency_limit: int
+        The number of concurrent processes below which jobs may share an ms.
+
+    Returns
+    -------
+    The ascending list of numerical ids to be included in the array, or None if the jobs need to be submitted 
+    individually. Any remaining jobs not in the list are left to be submitted individually.
+    """
+    completed_files, failed_files = scan_status_folder(status_folder)
+    finished_ids = completed_files | failed_files
+    # Components listed more than once are only run for their first id
+    array_ids = sorted(array_id for array_id in remaining_array_ids 
+                       if array_id not in active_ids and array_id not in finished_ids 
+                       and name_to_id[targets[array_id-1]] == array_id)
+    if len(array_ids) < 2:
+        print('Too few jobs to run as a job array')
+        return None
+
+    # The array covers a contiguous range, any other ids within it must already be finished so they will be skipped.
+    # The array ends before the first id which can't be skipped, leaving the later jobs to be submitted individually.
+    in_array = set(array_ids)
+    for array_id in range(array_ids[0], array_ids[-1]+1):
+        if array_id not in in_array and array_id not in finished_ids:
+            print('Ending the job array before job #{} as it is not a target, is active or repeats a component'.format(
+                array_id))
+            array_ids = [arr_id for arr_id in array_ids if arr_id < array_id]
+            break
+    if len(array_ids) < 2:
+        print('Too few jobs to run as a job array')
+        return None
+
+    # PBS will start jobs without regard for their ms, which is only safe if no ms are shared
+    if min_concurrency_limit < concurrency_limit:
+        used_ms = set(active_ms)
+        for array_id in array_ids:
+            tgt_ms = src_beam_map[targets[array_id-1]]
+            if not used_ms.isdisjoint(tgt_ms):
+                print('Job #{} shares an ms with another job'.format(array_id))
+                return None
+            used_ms.update(tgt_ms)
+    return array_ids
+
+
+def count_running(active_ids, array_id_set, concurrency_limit):
+    # Jobs from a job array beyond the concurrency limit are still waiting in the PBS queue
+    num_queued = max(0, len(active_ids & array_id_set) - concurrency_limit)
+    return len(active_ids) - num_queued, num_queued
+
+
+def rebuild_start_queue(start_queue, remaining_array_ids, active_ids, blocked_ids):
+    # Heap of (number of active ms used, id) for each job which could be started
+    start_queue[:] = [(blocked_ids[array_id], array_id) for array_id in remaining_array_ids 
+                      if array_id not in active_ids]
+    heapq.heapify(start_queue)
+
+
+def register_active(targets, src_beam_map, active_ids, active_ms, ms_to_ids, blocked_ids, start_queue, pre_active_jobs, 
+                    remaining_array_ids, status_folder):
     if pre_active_jobs:
         active_ids.update(pre_active_jobs)
 
+    status_prefix = status_folder + '/'
     for array_id in remaining_array_ids:
-        if os.path.isfile('{}/{:d}.ACTIVE'.format(status_folder, array_id)):
+        if os.path.isfile(status_prefix + str(array_id) + '.ACTIVE'):
             active_ids.add(array_id)
 
     for array_id in active_ids:
         comp_name = targets[array_id-1]
         tgt_ms = src_beam_map[comp_name]
 
-        for ms in tgt_ms:
-            active_ms.append(ms)
+        add_active_ms(tgt_ms, active_ms, ms_to_ids, blocked_ids, start_queue)
         # print ('+++ ' + str(active_ids))
         print('Registered active job {} (#{}) concurrency {} ms: {}'.format(
             comp_name, array_id, len(active_ids), tgt_ms))
+    rebuild_start_queue(start_queue, remaining_array_ids, active_ids, blocked_ids)
     return len(active_ids)
 
 
-def mark_comp_done(array_id, tgt_ms, active_ids, active_ms):
+def add_active_ms(tgt_ms, active_ms, ms_to_ids, blocked_ids, start_queue):
+    # Each id in blocked_ids counts the active ms it uses. Any earlier start_queue entries for an id are left 
+    # in the queue and are discarded when they no longer match its count.
+    for ms in tgt_ms:
+        if not active_ms[ms]:
+            for array_id in ms_to_ids[ms]:
+                blocked_ids[array_id] += 1
+                heapq.heappush(start_queue, (blocked_ids[array_id], array_id))
+    active_ms.update(tgt_ms)
+
+
+def mark_comp_done(array_id, tgt_ms, active_ids, active_ms, ms_to_ids, blocked_ids, start_queue):
     active_ids.remove(array_id)
+    # Subtracting a Counter drops any ms which are no longer in use
+    active_ms -= collections.Counter(tgt_ms)
     for ms in tgt_ms:
-        active_ms.remove(ms)
+        if not active_ms[ms]:
+            for other_id in ms_to_ids[ms]:
+                blocked_ids[other_id] -= 1
+                if blocked_ids[other_id] <= 0:
+                    del blocked_ids[other_id]
+                heapq.heappush(start_queue, (blocked_ids[other_id], other_id))
 
 
-def job_loop(targets, sbid, status_folder, src_beam_map, active_ids, active_ms, remaining_array_ids, completed_srcs,
-             failed_srcs, concurrency_limit, min_concurrency_limit, use_pbs, log_folder):
-    rate_limited = False
+def watch_status_folder(status_folder):
+    """
+    Start watching the status folder for job completion or failure files.
+
+    Parameters
+    ----------
+    status_folder: str
+        The folder which will contain the job completion or failed files.
+
+    Returns
+    -------
+    An INotify instance watching the folder, or None if inotify is not available.
+    """
+    if INotify is None:
+        print ('inotify_simple is not available, will poll for completed jobs')
+        return None
+    watcher = INotify()
+    watcher.add_watch(status_folder, flags.CLOSE_WRITE | flags.MOVED_TO)
+    return watcher
+
+
+def open_status_socket(status_folder):
+    """
+    Open a local datagram socket on which jobs can wake the daemon when they have completed or failed.
+
+    Parameters
+    ----------
+    status_folder: str
+        The folder which will contain the job completion or failed files. The socket is created here, named 
+        for this process, as several daemons may be running for the same sbid.
+
+    Returns
+    -------
+    The bound socket and the inode of its file, or None, None if it could not be created.
+    """
+    path = os.path.join(status_folder, 'daemon_{}.sock'.format(os.getpid()))
+    sock = None
+    try:
+        # The path is unique to this process, so any existing file was left by an earlier process with our pid
+        if os.path.exists(path):
+            os.remove(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        sock_ino = os.stat(path).st_ino
+    except OSError as e:
+        print ('Unable to listen on {}, will rely on status files: {}'.format(path, e))
+        if sock is not None:
+            sock.close()
+        return None, None
+    sock.setblocking(False)
+    return sock, sock_ino
+
+
+def close_status_socket(sock, sock_ino):
+    path = sock.getsockname()
+    sock.close()
+    # Only remove the socket file if it is still the one we created
+    try:
+        if os.stat(path).st_ino == sock_ino:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def drain_status_socket(sock):
+    # Each message is just a wake up, the status folder scan finds which jobs have finished
+    woken = False
+    while True:
+        try:
+            sock.recv(256)
+        except BlockingIOError:
+            break
+        woken = True
+    return woken
+
+
+def wait_for_status_change(watcher, sock, delay):
+    """
+    Wait for jobs to complete or fail, or for the delay to expire.
+
+    Parameters
+    ----------
+    watcher: INotify
+        The watcher for the status folder, or None if inotify is not available.
+    sock: socket
+        The socket on which jobs wake the daemon when they finish, or None if it is not in use.
+    delay: int
+        The maximum number of seconds to wait.
+
+    Returns
+    -------
+    True if a job has completed or failed, False if the delay expired first.
+    """
+    sources = [source for source in (watcher, sock) if source is not None]
+    if not sources:
+        time.sleep(delay)
+        return False
+
+    # Keep waiting until a job finishes, ignoring other changes such as .ACTIVE files being written
+    deadline = time.monotonic() + delay
+    while True:
+        remaining_time = deadline - time.monotonic()
+        if remaining_time <= 0:
+            # Neither events nor messages arrive for jobs run on other hosts (e.g. via PBS), 
+            # these are found by the status folder scan each loop
+            return False
+        readable, _, _ = select.select(sources, [], [], remaining_time)
+        job_finished = False
+        if watcher in readable:
+            # Wait briefly after the first event so that close together completions are handled together
+            events = watcher.read(timeout=0, read_delay=100)
+            job_finished = any(STATUS_RE.match(event.name) for event in events)
+        if sock in readable:
+            job_finished = drain_status_socket(sock)
+        if job_finished:
+            return True
+
+
+def scan_status_folder(status_folder):
+    """
+    Find the jobs which have completed or failed by listing the status folder once.
+
+    Parameters
+    ----------
+    status_folder: str
+        The folder which will contain the job completion or failed files.
+
+    Returns
+    -------
+    The set of numerical ids of completed jobs and the set of numerical ids of failed jobs.
+    """
+    done_ids = set()
+    failed_ids = set()
+    with os.scandir(status_folder) as entries:
+        for entry in entries:
+            m = STATUS_RE.match(entry.name)
+            if m:
+                (done_ids if m.group(2) == 'COMPLETED' else failed_ids).add(int(m.group(1)))
+    return done_ids, failed_ids
+
+
+def job_loop(targets, name_to_id, job_template, status_folder, src_beam_map, active_ids, active_ms, ms_to_ids, blocked_ids,
+             start_queue, remaining_array_ids, completed_ids, failed_ids, concurrency_limit, min_concurrency_limit, 
+             use_pbs, pending_launches, submit_failures, verbose=False, status_socket=None, submit_pool=None,
+             array_id_set=frozenset()):
+    # Check on the jobs launched in earlier loops
+    for array_id in check_launches(pending_launches):
+        if use_pbs and array_id in active_ids:
+            submit_failures[array_id] += 1
+            if submit_failures[array_id] >= MAX_SUBMIT_ATTEMPTS:
+                raise CommandFailedError('Submission failed {} times for {} (#{})'.format(
+                    submit_failures[array_id], targets[array_id-1], array_id))
+            # The job was never queued, so free it up to be submitted again
+            print('Submission failed for {} (#{}), will retry'.format(targets[array_id-1], array_id))
+            mark_comp_done(array_id, src_beam_map[targets[array_id-1]], active_ids, active_ms, ms_to_ids, blocked_ids,
+                           start_queue)
+            heapq.heappush(start_queue, (blocked_ids[array_id], array_id))
+    completed_files, failed_files = scan_status_folder(status_folder)
+    finished_ids = completed_files | failed_files
     # Take a copy of the list to avoid issues when removing items from it
-    ids_to_scan = list(remaining_array_ids)
+    ids_to_scan = [array_id for array_id in remaining_array_ids if array_id in finished_ids]
     # Scan for completed jobs
     for array_id in ids_to_scan:
         comp_name = targets[array_id-1]
-        if comp_name in completed_srcs or comp_name in failed_srcs:
+        # Components are tracked by the first id they are listed with
+        comp_id = name_to_id[comp_name]
+        if comp_id in completed_ids or comp_id in failed_ids:
             continue
 
-        if os.path.isfile('{}/{:d}.COMPLETED'.format(status_folder, array_id)):
+        if array_id in completed_files:
             # print ('--- ' + str(active_ids))
             if array_id in active_ids:
-                print('Completed {}  (#{}) concurrency {}'.format(comp_name, array_id, len(active_ids)))
-                mark_comp_done(array_id, src_beam_map[comp_name], active_ids, active_ms)
-            else:
+                print('Completed {}  (#{}) concurrency {}'.format(
+                    comp_name, array_id, count_running(active_ids, array_id_set, concurrency_limit)[0]))
+                mark_comp_done(array_id, src_beam_map[comp_name], active_ids, active_ms, ms_to_ids, blocked_ids,
+                               start_queue)
+            elif verbose:
                 print(' Skipping {} (#{}) as it has already completed'.format(comp_name, array_id))
-            completed_srcs.add(comp_name)
-            remaining_array_ids.remove(array_id)
+            completed_ids.add(comp_id)
+            del remaining_array_ids[array_id]
             continue
 
-        if os.path.isfile('{}/{:d}.FAILED'.format(status_folder, array_id)):
+        if array_id in failed_files:
             if array_id in active_ids:
-                print('Failed {}  (#{}) concurrency {}'.format(comp_name, array_id, len(active_ids)))
-                mark_comp_done(array_id, src_beam_map[comp_name], active_ids, active_ms)
-            else:
+                print('Failed {}  (#{}) concurrency {}'.format(
+                    comp_name, array_id, count_running(active_ids, array_id_set, concurrency_limit)[0]))
+                mark_comp_done(array_id, src_beam_map[comp_name], active_ids, active_ms, ms_to_ids, blocked_ids,
+                               start_queue)
+            elif verbose:
                 print(' Skipping {} (#{}) as it has already failed'.format(comp_name, array_id))
-            failed_srcs.add(comp_name)
-            remaining_array_ids.remove(array_id)
+            failed_ids.add(comp_id)
+            del remaining_array_ids[array_id]
             continue
 
-    # Scan for jobs to start
-    ids_to_scan = list(remaining_array_ids)
-    for array_id in ids_to_scan:
-        if array_id in active_ids:
-            #print ('{} is active'.format(array_id))
+    # Discard stale queue entries once they greatly outnumber the jobs left
+    if len(start_queue) > 4 * len(remaining_array_ids) + concurrency_limit:
+        rebuild_start_queue(start_queue, remaining_array_ids, active_ids, blocked_ids)
+
+    # Start jobs, least blocked by active ms first
+    while start_queue and len(active_ids) < concurrency_limit:
+        num_blocking, array_id = start_queue[0]
+        if array_id not in remaining_array_ids or array_id in active_ids or blocked_ids[array_id] != num_blocking:
+            # Stale entry - the job has finished, started or its count has changed
+            heapq.heappop(start_queue)
             continue
+        if num_blocking > 0 and len(active_ids) > min_concurrency_limit:
+            # Every remaining job would share an ms with an active job
+            break
+        heapq.heappop(start_queue)
 
         comp_name = targets[array_id-1]
-        if comp_name in completed_srcs:
+        if name_to_id[comp_name] in completed_ids:
             print ('{} (#{}) has already completed as a different id!'.format(comp_name, array_id))
-            remaining_array_ids.remove(array_id)
+            del remaining_array_ids[array_id]
             continue
 
-
         tgt_ms = src_beam_map[comp_name]
-        if len(active_ids) > min_concurrency_limit:
-            clash = False
-            for ms in tgt_ms:
-                if ms in active_ms:
-                    clash = True
-            if clash:
-                continue
+        add_active_ms(tgt_ms, active_ms, ms_to_ids, blocked_ids, start_queue)
+        active_ids.add(array_id)
+        # print ('+++ ' + str(active_ids))
+        print('Starting {} (#{}) concurrency {} ms: {}'.format(
+            comp_name, array_id, len(active_ids), tgt_ms))
+        # run_os_cmd(['./make_askap_abs_cutout.sh', str(array_id), str(sbid), status_folder])
+        proc = launch_job(array_id, job_template, use_pbs, status_socket=status_socket, submit_pool=submit_pool)
+        pending_launches.append((array_id, proc))
 
-        if len(active_ids) < concurrency_limit:
-            rate_limited = False
-            for ms in tgt_ms:
-                active_ms.append(ms)
-            active_ids.add(array_id)
-            # print ('+++ ' + str(active_ids))
-            print('Starting {} (#{}) concurrency {} ms: {}'.format(
-                comp_name, array_id, len(active_ids), tgt_ms))
-            # run_os_cmd('./make_askap_abs_cutout.sh {} {}'.format(array_id, status_folder))
-            me = Path(__file__)
-            script = Path(me.parent, 'start_job.pbs')
-            script_folder = me.parent
-
-            if use_pbs:
-                run_os_cmd(
-                    ('qsub -v COMP_INDEX={0},SBID={2},STATUS_DIR={3},SCRIPT_DIR={4} -N "ASKAP_abs{0}" -o {1}/askap_abs_{0}_o.log '
-                     '-e {1}/askap_abs_{0}_e.log {5}').format(array_id, log_folder, sbid, status_folder, script_folder, 
-                     script))
-            else:
-                run_os_cmd('{} {} {} "{}"'.format(script, array_id, sbid, status_folder))
-        elif not rate_limited:
-            rate_limited = True
-            print (' rate limit of {} applied'.format(concurrency_limit))
-    return len(active_ids)
+    if len(active_ids) >= concurrency_limit and len(remaining_array_ids) > len(active_ids):
+        print (' rate limit of {} applied'.format(concurrency_limit))
 
 
 def produce_all_cutouts(targets, sbid, status_folder, src_beam_map, delay, concurrency_limit, min_concurrency_limit, use_pbs,
-                        log_folder, pre_active_jobs, target_list, max_loops=500):
-    remaining_array_ids = list(range(1, len(targets)+1))
+                        log_folder, pre_active_jobs, target_list, max_loops=500, verbose=False, use_job_array=False):
+    # A dict keeps the ids in order while allowing them to be removed cheaply
+    remaining_array_ids = dict.fromkeys(range(1, len(targets)+1))
     if target_list:
-        remaining_array_ids = list(target_list)
+        remaining_array_ids = dict.fromkeys(target_list)
     num_targets = len(remaining_array_ids)
-    active_ms = list()
+    # Count of active jobs using each ms
+    active_ms = collections.Counter()
+    # Count of active ms used by each id, only ids using an active ms are present
+    blocked_ids = collections.Counter()
+    ms_to_ids = build_ms_index(targets, src_beam_map)
+    start_queue = []
     active_ids = set()
-    completed_srcs = set()
-    failed_srcs = set()
+    pending_launches = []
+    submit_failures = collections.Counter()
+    completed_ids = set()
+    failed_ids = set()
+    # Map each component name to the first id it is listed with
+    name_to_id = dict()
+    for idx, comp_name in enumerate(targets):
+        name_to_id.setdefault(comp_name, idx+1)
 
     total_concurrency = 0
     print('Processing {} targets'.format(len(remaining_array_ids)))
 
-    num_running = register_active(targets, src_beam_map, active_ids, active_ms, pre_active_jobs, remaining_array_ids, 
-                                    status_folder)
-    total_concurrency += num_running
-    i = 0
-    while len(remaining_array_ids) > 0 and i < max_loops:
-        i += 1
-        print("\nLoop #{}, completed {} failed {} running {} remaining {} at {}".format(
-            i, len(completed_srcs), len(failed_srcs), num_running, len(remaining_array_ids)-num_running, 
-            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))), flush=True)
-        num_running = job_loop(targets, sbid, status_folder, src_beam_map, active_ids, active_ms, remaining_array_ids,
-                                      completed_srcs, failed_srcs, concurrency_limit, min_concurrency_limit, use_pbs, 
-                                      log_folder)
-        total_concurrency += num_running
-        if len(remaining_array_ids) > 0:
-            time.sleep(delay)
+    # Start watching before the first scan so that no completions are missed
+    watcher = watch_status_folder(status_folder)
+    # Local jobs only need to wake us through the socket if inotify isn't available
+    sock, sock_ino = (None, None) if use_pbs or watcher is not None else open_status_socket(status_folder)
+    status_socket = sock.getsockname() if sock is not None else None
+    job_template = build_job_template(sbid, status_folder, log_folder, use_pbs)
+
+    # Make sure the watcher, socket and submission threads are cleaned up even if a submission fails
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+            submit_pool = pool if use_pbs else None
+
+            num_running = register_active(targets, src_beam_map, active_ids, active_ms, ms_to_ids, blocked_ids, 
+                                          start_queue, pre_active_jobs, remaining_array_ids, status_folder)
+            num_queued = 0
+            array_id_set = frozenset()
+
+            if use_pbs and use_job_array:
+                array_ids = find_job_array_ids(targets, name_to_id, src_beam_map, status_folder, remaining_array_ids, 
+                                               active_ids, active_ms, concurrency_limit, min_concurrency_limit)
+                if array_ids:
+                    print('Submitting jobs #{} to #{} as a job array'.format(array_ids[0], array_ids[-1]))
+                    submit_job_array(array_ids[0], array_ids[-1], sbid, status_folder, log_folder, concurrency_limit)
+                    # All of the jobs are now queued, so the daemon just needs to wait for them to finish
+                    for array_id in array_ids:
+                        active_ids.add(array_id)
+                        add_active_ms(src_beam_map[targets[array_id-1]], active_ms, ms_to_ids, blocked_ids, 
+                                      start_queue)
+                    array_id_set = frozenset(array_ids)
+                    num_running, num_queued = count_running(active_ids, array_id_set, concurrency_limit)
+                else:
+                    print('Falling back to submitting each job individually')
+            i = 0
+            # Limit the run by time, as jobs finishing cut the waits short
+            run_start = time.monotonic()
+            deadline = run_start + max_loops * delay
+            while len(remaining_array_ids) > 0 and time.monotonic() < deadline:
+                i += 1
+                now_str = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                queued_str = ' queued {}'.format(num_queued) if array_id_set else ''
+                print("\nLoop #{}, completed {} failed {} running {}{} remaining {} at {}".format(
+                    i, len(completed_ids), len(failed_ids), num_running, queued_str, 
+                    len(remaining_array_ids)-num_running-num_queued, now_str), flush=True)
+                job_loop(targets, name_to_id, job_template, status_folder, src_beam_map, active_ids, active_ms, 
+                         ms_to_ids, blocked_ids, start_queue, remaining_array_ids, completed_ids, failed_ids, 
+                         concurrency_limit, min_concurrency_limit, use_pbs, pending_launches, submit_failures, 
+                         verbose=verbose, status_socket=status_socket, submit_pool=submit_pool, 
+                         array_id_set=array_id_set)
+                num_running, num_queued = count_running(active_ids, array_id_set, concurrency_limit)
+                if len(remaining_array_ids) > 0:
+                    # Weight the concurrency by how long it lasted, as waits end early when jobs finish
+                    wait_start = time.monotonic()
+                    wait_for_status_change(watcher, sock, min(delay, max(0, deadline - wait_start)))
+                    total_concurrency += num_running * (time.monotonic() - wait_start)
+    finally:
+        if watcher is not None:
+            watcher.close()
+        if sock is not None:
+            close_status_socket(sock, sock_ino)
 
     if len(remaining_array_ids) > 0:
-        msg = 'ERROR: Failed to complete processing after {} loops. {} cutouts remain'.format(
-            i, len(remaining_array_ids))
+        msg = 'ERROR: Failed to complete processing after {} loops ({:.0f} seconds). {} cutouts remain'.format(
+            i, time.monotonic() - run_start, len(remaining_array_ids))
         print('\n'+msg)
         raise Exception(msg)
     else:
+        elapsed = time.monotonic() - run_start
         print('\nCompleted processing in {} loops with average concurrency {:.2f}'.format(
-            i, total_concurrency/i))
+            i, total_concurrency/elapsed if elapsed > 0 else 0))
     return num_targets
     
 
@@ -362,11 +911,15 @@ def main():
     # Parse command line options
     args = parseargs()
 
+    # Flush each line so our output stays in order with that of the jobs we launch
+    sys.stdout.reconfigure(line_buffering=True)
+
     start = time.time()
     print("#### Started ASKAP cutout production of sbid {} at {} ####".format
           (args.sbid, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start))))
 
-    print ('Checking every {} seconds for completed jobs, with a maximum of {} checks.'.format(args.delay, args.max_loops))
+    print ('Checking for completed jobs as they finish and at least every {} seconds, for a maximum of {} seconds.'.format(
+        args.delay, args.max_loops * args.delay))
 
     work_folder = 'sb{}/work'.format(args.sbid)
     cutouts_folder = 'sb{}/cutouts'.format(args.sbid)
@@ -376,11 +929,11 @@ def main():
     print (' Source filename', args.filename)
     print (' Target list', args.target)
     print (' Concurrency max {} min {}'.format(args.concurrency_limit, args.min_concurrency_limit))
-    print (' Batch system', ('PBS' if args.pbs else 'None'))
+    print (' Batch system', ('PBS job array' if args.pbs and args.use_job_array else 'PBS' if args.pbs else 'None'))
 
     # Prepare the run
-    #targets, image_params = read_image_params(args.filename)
-    #src_beam_map = build_map(image_params)
+    #targets, names, beams = read_image_params(args.filename)
+    #src_beam_map = build_map(names, beams)
     targets, src_beam_map = get_source_list(args.filename)
     target_list = build_target_list(targets, args.target, args.target_file)
 
@@ -399,7 +952,8 @@ def main():
     # Run through the processing
     num_targets = produce_all_cutouts(targets, args.sbid, status_folder, src_beam_map, args.delay, 
                         args.concurrency_limit, args.min_concurrency_limit, args.pbs, 
-                        log_folder, args.active, target_list, max_loops=args.max_loops)
+                        log_folder, args.active, target_list, max_loops=args.max_loops, verbose=args.verbose, 
+                        use_job_array=args.use_job_array)
 
     # Report
     end = time.time()
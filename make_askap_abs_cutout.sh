@@ -8,6 +8,15 @@ SBID="$2"
 status_folder="$3"
 SCRIPT_DIR=`dirname "$0"`
 
+# Let the daemon know the job has finished, if it is listening on a local socket.
+# The daemon may exit and remove the socket after the check, so any error is ignored.
+notify_daemon() {
+    if [ -n "${STATUS_SOCKET}" ] && [ -S "${STATUS_SOCKET}" ]; then
+        python3 -c 'import socket, sys; socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM).sendto(b"\n", sys.argv[1])' \
+            "${STATUS_SOCKET}" 2>/dev/null || true
+    fi
+}
+
 # Run the cutout script in CASA
 export SAMPLE_ID
 export SBID
@@ -23,8 +32,10 @@ rm ${status_folder}/${SAMPLE_ID}.ACTIVE
 if [ $retval -ne 0 ]; then
     echo "Job failed"
     echo `date` > ${status_folder}/${SAMPLE_ID}.FAILED
+    notify_daemon
     exit 1
 fi
 
 echo `date` > ${status_folder}/${SAMPLE_ID}.COMPLETED
+notify_daemon
 exit 0